@@ -0,0 +1,28 @@
+import functools
+
+import boto3
+from botocore.config import Config
+
+# the number of connections each client keeps, and so the number of requests
+# that can be in flight on a client at once
+MAX_POOL_CONNECTIONS = 32
+
+# back off and retry if we get throttled
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS, retries={
+        'max_attempts': 10, 'mode': 'adaptive'
+    })
+
+
+def client(service, region=None):
+  """
+  Returns a client for the given service and region, creating it on first use
+  as clients are expensive to create.
+  """
+  # always pass region so client('ec2') and client('ec2', None) share a client
+  return _client(service, region)
+
+
+@functools.lru_cache(maxsize=None)
+def _client(service, region):
+  return boto3.client(service, region_name=region, config=CLIENT_CONFIG)
@@ -2,7 +2,7 @@
 
 from datetime import datetime, timedelta
 
-import boto3
+from clients import client
 
 MAX_AVAILABLE = 20
 MAX_IN_USE_OVER_200GB = 10
@@ -12,49 +12,45 @@ REPORTING_LOOKBACK_TIME_HOURS = 48
 REPORTING_PERIOD_SECS = 5 * 60
 
 
-class Volume(dict):
+class Volume:
+  # only the fields of the describe_volumes response that we use are kept
+  __slots__ = ('VolumeId', 'State', 'Size', '_name')
+
   def __init__(self, volume_info):
-    super().__init__(volume_info)
-    self.__dict__.update(volume_info)
+    self.VolumeId = volume_info['VolumeId']
+    self.State = volume_info['State']
+    self.Size = volume_info['Size']
+    self._name = next(
+        (tag['Value'] for tag in volume_info.get('Tags', []) if tag['Key'] == 'Name'),
+        '<No Name>')
 
   @property
   def name(self):
-    if 'Tags' in self:
-      for tag in self.Tags:
-        if tag['Key'] == 'Name':
-          return tag['Value']
-
-    return '<No Name>'
+    return self._name
 
   @property
   def available_metrics(self):
     """
     Poorly implemented only used for quick debugging.
     """
-    cw = boto3.client('cloudwatch')
+    paginator = client('cloudwatch').get_paginator('list_metrics')
     metrics_vec = []
-    nexttoken = ''
-    done = False
-    while not done:
-      resp = cw.list_metrics(
-          Namespace='AWS/EBS', Dimensions=[{
-              'Name': 'VolumeId', 'Value': self.VolumeId
-          }])
-      for m in resp['Metrics']:
-        metrics_vec.append(f'{m["Namespace"]}:{m["MetricName"]} D={m["Dimensions"]}')
-
-      nexttoken = resp.get('NextToken')
-      if nexttoken is None:
-        done = True
+    for page in paginator.paginate(
+        Namespace='AWS/EBS', Dimensions=[{
+            'Name': 'VolumeId', 'Value': self.VolumeId
+        }]):
+      metrics_vec.extend(
+          f'{m["Namespace"]}:{m["MetricName"]} D={m["Dimensions"]}' for m in page['Metrics'])
 
     return metrics_vec
 
   @property
   def time_spent_idle(self):
-    # TODO: I can't get this work, no matter what I do I get no datapoints. So for now we can't
-    # do idleness base checks :(
+    # TODO: this used to get no datapoints because it asked for Unit='None' when
+    # VolumeReadOps is a Count. Nothing works out idleness from the datapoints yet
+    # though, so for now we can't do idleness based checks
 
-    cw = boto3.client('cloudwatch')
+    cw = client('cloudwatch')
     now = datetime.utcnow()
     resp = cw.get_metric_statistics(
         Namespace='AWS/EBS',
@@ -63,10 +59,9 @@ class Volume(dict):
             'Name': 'VolumeId', 'Value': self.VolumeId
         }],
         StartTime=now - timedelta(hours=REPORTING_LOOKBACK_TIME_HOURS),
-        EndTime=now.utcnow(),
+        EndTime=now,
         Period=REPORTING_PERIOD_SECS,
-        Statistics=['Sum'],
-        Unit='None')  # noqc
+        Statistics=['Sum'])
 
     assert resp
     return -1
@@ -86,30 +81,36 @@ def ebs_reaper(slack_send_func=None):
   :return: list of EBSVolume instances to reap
   """
 
-  ec2 = boto3.client('ec2')
-
-  volumes_vec = []
-  done = False
-  nexttoken = ''
-  while not done:
-    resp = ec2.describe_volumes(Filters=[{'Name': 'status', 'Values': ['in-use', 'available']}])
+  ec2 = client('ec2')
 
-    nexttoken = resp.get('NextToken')
-    if nexttoken is None:
-      done = True
+  paginator = ec2.get_paginator('describe_volumes')
 
-    for v in resp['Volumes']:
-      volumes_vec.append(Volume(v))
+  volumes_vec = []
+  for page in paginator.paginate(
+      Filters=[{'Name': 'status', 'Values': ['in-use', 'available']}],
+      PaginationConfig={'PageSize': 500}):
+    volumes_vec.extend(Volume(v) for v in page['Volumes'])
+
+  # output is buffered and written out in one go rather than a print per volume
+  lines = []
+  total_size = 0
+  available_volumes = []
+  inuse_volumes_over_200GB = []
+  for v in volumes_vec:
+    size = v.Size
+    state = v.State
 
-  total_size = sum(v.Size for v in volumes_vec)
-  available_volumes = [v for v in volumes_vec if v.State == 'available']
-  inuse_volumes_over_200GB = [v for v in volumes_vec if v.State == 'in-use' and v.Size > 200]
+    total_size += size
+    if state == 'available':
+      available_volumes.append(v)
+    elif state == 'in-use' and size > 200:
+      inuse_volumes_over_200GB.append(v)
 
-  for v in volumes_vec:
-    print(f'{v.name:64s}  {v.State:10s}  {v.Size:6d} GB')
+    lines.append(f'{v.name:64s}  {state:10s}  {size:6d} GB')
 
-  print('-' * 87)
-  print(f'{"Total Size":64s}  {"":10s}  {total_size:6d} GB')
+  lines.append('-' * 87)
+  lines.append(f'{"Total Size":64s}  {"":10s}  {total_size:6d} GB')
+  print('\n'.join(lines))
 
   def warn(msg):
     if slack_send_func:
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
-import json
+import fcntl
 import os
 import re
+import shelve
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-import boto3
 import click
 import requests
 
+from clients import MAX_POOL_CONNECTIONS, client
 from ebs import ebs_reaper
 
 # the small unit of time over which we report on
@@ -22,9 +25,95 @@ REPORTING_LOOKBACK_TIME_HOURS = 72
 
 SLACK_WEB_HOOK_ENV_VAR = 'SLACK_WEB_HOOK'
 SLACK_CHANNEL_ENV_VAR = 'SLACK_CHANNEL'
+SLACK_TIMEOUT_SECS = 5
+
+# shared so that messages sent during a run reuse the connection to slack
+_SLACK_SESSION = requests.Session()
 
 INSTANCE_TYPE_REGEX = re.compile('.large')
 
+# the maximum number of queries CloudWatch accepts in a single GetMetricData call
+MAX_METRIC_DATA_QUERIES = 500
+
+# keys under which the window the metric cache was filled for, and the disk
+# metric families seen so far, are stored
+METRIC_CACHE_WINDOW_KEY = '__window__'
+METRIC_CACHE_DISK_METRIC_FAMILIES_KEY = '__disk_metric_families__'
+
+# the number of CloudWatch requests we have in flight at once. Each needs a
+# connection from the shared client's pool, so use half the pool to leave
+# headroom and have workers never wait on a connection
+MAX_WORKERS = MAX_POOL_CONNECTIONS // 2
+
+
+def instance_family(instance_type):
+  """
+  Returns the family of an instance type, e.g. m5 for m5.large.
+  """
+  return instance_type.split('.')[0]
+
+
+# maps (region, instance family) e.g. (None, 'm5') to the prefix of the disk
+# metrics its instances report, either 'EBS' or 'Disk'. See disk_metric_family
+_DISK_METRIC_FAMILIES = {}
+
+
+def disk_metric_family(instance_id, instance_type, region=None):
+  """
+  Returns the prefix of the disk metrics reported by the given instance,
+  either 'EBS' (EBSReadOps etc.) or 'Disk' (DiskReadOps etc.).
+
+  This depends on the instance family so CloudWatch, in the given region, is
+  only asked once per family.
+  """
+  key = (region, instance_family(instance_type))
+  if key not in _DISK_METRIC_FAMILIES:
+    resp = client('cloudwatch', region).list_metrics(
+        Namespace='AWS/EC2', Dimensions=[{
+            'Name': 'InstanceId', 'Value': instance_id
+        }])
+    metricnames = {m['MetricName'] for m in resp['Metrics']}
+    if 'EBSReadOps' in metricnames:
+      _DISK_METRIC_FAMILIES[key] = 'EBS'
+    elif 'DiskReadOps' in metricnames:
+      _DISK_METRIC_FAMILIES[key] = 'Disk'
+    else:
+      # this instance has no disk metrics yet, so don't remember the answer
+      # and let the next instance of this family decide
+      return 'EBS'
+
+  return _DISK_METRIC_FAMILIES[key]
+
+
+def probe_disk_metric_families(instances):
+  """
+  Looks up the disk metric family of every instance in instances, asking
+  CloudWatch concurrently rather than one after another as disk_metric_family
+  is used.
+  """
+
+  def unknown_families():
+    unknown = {}
+    for inst in instances:
+      key = (inst.region, instance_family(inst.InstanceType))
+      if key not in _DISK_METRIC_FAMILIES:
+        unknown.setdefault(key, []).append(inst)
+    return unknown
+
+  # list forces any exceptions to be raised here
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    # ask about one instance of every unknown family, the answer then holds for
+    # the rest of the family
+    list(executor.map(lambda insts: insts[0].disk_metric_family, unknown_families().values()))
+
+    # families still unknown had no disk metrics for the instance we asked
+    # about, so ask about each of their instances. Instances already asked
+    # remember their answer and won't ask again
+    list(
+        executor.map(
+            lambda inst: inst.disk_metric_family,
+            [inst for insts in unknown_families().values() for inst in insts]))
+
 
 def slack_send(msg):
   webhook = os.environ.get(SLACK_WEB_HOOK_ENV_VAR)
@@ -37,7 +126,7 @@ def slack_send(msg):
   if channel:
     payload['channel'] = channel
 
-  req = requests.post(webhook, data=json.dumps(payload))
+  req = _SLACK_SESSION.post(webhook, json=payload, timeout=SLACK_TIMEOUT_SECS)
   if req.status_code != 200:
     print('Response:', req.status_code, req.content)
 
@@ -58,21 +147,46 @@ def stop_instance(inst):
   print(f'Stopping instance {inst}')
 
 
-class Instance(dict):
-  def __init__(self, instance_dict, min_cpu_utilisation, min_disk_ops, min_network_packets):
-    super().__init__(instance_dict)
-    self.__dict__.update(instance_dict)
+class Instance:
+  # only the fields of the describe_instances response that we use are kept
+  __slots__ = (
+      'InstanceId',
+      'InstanceType',
+      'State',
+      '_name',
+      '_min_cpu',
+      '_min_disk',
+      '_min_network',
+      '_region',
+      '_disk_metric_family',
+      'metric_data',
+  )
+
+  def __init__(
+      self, instance_dict, min_cpu_utilisation, min_disk_ops, min_network_packets, region=None):
+    self.InstanceId = instance_dict['InstanceId']
+    self.InstanceType = instance_dict['InstanceType']
+    self.State = instance_dict['State']
+    self._name = next(
+        (tag['Value'] for tag in instance_dict.get('Tags', []) if tag['Key'] == 'Name'),
+        '<NO NAME>')
 
     self._min_cpu = min_cpu_utilisation
     self._min_disk = min_disk_ops
     self._min_network = min_network_packets
+    self._region = region
+    self._disk_metric_family = None
+
+    # maps metric name to (timestamps, values), see fetch_metric_data
+    self.metric_data = {}
 
   @property
   def name(self):
-    for tagdict in self['Tags']:
-      if tagdict['Key'] == 'Name':
-        return tagdict['Value']
-    return '<NO NAME>'
+    return self._name
+
+  @property
+  def region(self):
+    return self._region
 
   @property
   def state(self):
@@ -84,112 +198,278 @@ class Instance(dict):
 
   @property
   def cpu_idle_period_hours(self):
-    return self.get_idle_period_hours_for_metric('CPUUtilization', 'Percent', self._min_cpu)
+    return self.get_idle_period_hours_for_metric('CPUUtilization', self._min_cpu)
 
   @property
   def network_idle_period_hours(self):
     packets_in_idle = self.get_idle_period_hours_for_metric(
-        'NetworkPacketsIn', 'Count', self._min_network)
+        'NetworkPacketsIn', self._min_network)
     packets_out_idle = self.get_idle_period_hours_for_metric(
-        'NetworkPacketsOut', 'Count', self._min_network)
+        'NetworkPacketsOut', self._min_network)
 
     return max(packets_in_idle, packets_out_idle)
 
   @property
-  def disk_idle_period_hours(self):
-    # XXX depending on instance type the metric is either
-    # DiskRead/WriteOps or EBSRead/WriteOps
-    disk_read_idle = self.get_idle_period_hours_for_metric('EBSReadOps', 'Count', self._min_disk)
-    if disk_read_idle < 0:
-      disk_read_idle = self.get_idle_period_hours_for_metric('DiskReadOps', 'Count', self._min_disk)
+  def disk_metric_family(self):
+    # remembered here as well as per family, as an instance without disk metrics
+    # doesn't settle the answer for its family and would otherwise ask again
+    if self._disk_metric_family is None:
+      self._disk_metric_family = disk_metric_family(
+          self.InstanceId, self.InstanceType, self._region)
+    return self._disk_metric_family
+
+  @property
+  def idleness_metrics(self):
+    """
+    Names of the metrics used to decide if this instance is idle.
+    """
+    family = self.disk_metric_family
+    return [
+        'CPUUtilization',
+        'NetworkPacketsIn',
+        'NetworkPacketsOut',
+        f'{family}ReadOps',
+        f'{family}WriteOps',
+    ]
 
-    disk_write_idle = self.get_idle_period_hours_for_metric('EBSWriteOps', 'Count', self._min_disk)
-    if disk_write_idle < 0:
-      disk_write_idle = self.get_idle_period_hours_for_metric(
-          'DiskWriteOps', 'Count', self._min_disk)
+  @property
+  def disk_idle_period_hours(self):
+    family = self.disk_metric_family
+    disk_read_idle = self.get_idle_period_hours_for_metric(f'{family}ReadOps', self._min_disk)
+    disk_write_idle = self.get_idle_period_hours_for_metric(f'{family}WriteOps', self._min_disk)
 
     return max(disk_read_idle, disk_write_idle)
 
   @property
   def idle_period_hours(self):
-    return min(
-        self.cpu_idle_period_hours, self.disk_idle_period_hours, self.network_idle_period_hours)
+    # an instance is only as idle as its least idle signal, so once a signal
+    # says it isn't idle there is no need to look at the others. CPU goes first
+    # as it is a single metric and the most likely to be active
+    cpu_idle = self.cpu_idle_period_hours
+    if cpu_idle <= 0:
+      return cpu_idle
+
+    disk_idle = self.disk_idle_period_hours
+    if disk_idle <= 0:
+      return disk_idle
+
+    return min(cpu_idle, disk_idle, self.network_idle_period_hours)
 
   @property
   def available_metrics(self):
     """
     Poorly implemented only used for quick debugging.
     """
-    cw = boto3.client('cloudwatch')
+    paginator = client('cloudwatch', self._region).get_paginator('list_metrics')
     metrics_vec = []
-    nexttoken = ''
-    done = False
-    while not done:
-      resp = cw.list_metrics(
-          Namespace='AWS/EC2', Dimensions=[{
-              'Name': 'InstanceId', 'Value': self.InstanceId
-          }])
-      for m in resp['Metrics']:
-        metrics_vec.append(f'{m["Namespace"]}:{m["MetricName"]}')
-
-      nexttoken = resp.get('NextToken')
-      if nexttoken is None:
-        done = True
+    for page in paginator.paginate(
+        Namespace='AWS/EC2', Dimensions=[{
+            'Name': 'InstanceId', 'Value': self.InstanceId
+        }]):
+      metrics_vec.extend(f'{m["Namespace"]}:{m["MetricName"]}' for m in page['Metrics'])
 
     return metrics_vec
 
-  def get_idle_period_hours_for_metric(self, metricname, unit, idle_threshold):
+  def get_idle_period_hours_for_metric(self, metricname, idle_threshold):
     """
     Returns the number of hours for which the specified metric was below the
     idle_threshold.
 
-    If the metric doesn't exist or returns no data points then -1 is
-    returned.
+    Datapoints are read from metric_data, which must have been populated
+    beforehand. If the metric doesn't exist or returns no data points then -1
+    is returned.
     """
-    cw = boto3.client('cloudwatch')
-    resp = cw.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName=metricname,
-        Dimensions=[{
-            'Name': 'InstanceId', 'Value': self.InstanceId
-        }],
-        StartTime=datetime.utcnow() - timedelta(hours=REPORTING_LOOKBACK_TIME_HOURS),
-        EndTime=datetime.utcnow(),
-        Period=REPORTING_PERIOD_SECS,
-        Statistics=['Average'],
-        Unit=unit)
-
-    idle_periods = []
-    datapoints = resp['Datapoints']
+    timestamps, values = self.metric_data.get(metricname, ([], []))
 
-    if len(datapoints) == 0:
+    if len(timestamps) == 0:
       return -1
 
-    for dp in resp['Datapoints']:
-      if dp['Average'] < idle_threshold:
-        idle_periods.append(dp['Timestamp'])
+    # timestamps are newest first (see fetch_metric_data) so we can find when
+    # the idle period started in a single pass, going back in time until there
+    # is more than a reporting period between idleness
+    reporting_period = timedelta(seconds=REPORTING_PERIOD_SECS)
+    idle_end = None
+    idle_start = None
+    for timestamp, value in zip(timestamps, values):
+      if value >= idle_threshold:
+        continue
+
+      if idle_end is None:
+        idle_end = timestamp
+      elif idle_start - timestamp > reporting_period:
+        # stop on the first break in idleness: this is the end of
+        # the most recent idle period
+        break
+
+      idle_start = timestamp
+
+    if idle_end is None:
+      # no idle datapoints means we haven't been idle
+      return 0
 
-    if len(idle_periods):
-      idle_periods.sort(reverse=True)
+    return (idle_end - idle_start).total_seconds() / 3600
 
-      # find when idle period started by going back in time and finding when was
-      # the last time there was more than a reporting period between idleness
-      idle_start = idle_periods[-1]
-      for cur, prev in zip(idle_periods[:-1], idle_periods[1:]):
-        if cur - prev > timedelta(seconds=REPORTING_PERIOD_SECS):
-          idle_start = cur
+  def __str__(self):
+    return f'{self.name:64s}  {self.InstanceId}  {self.InstanceType:16s} {self.state}'
 
-          # stop on the first break in idleness: this is the end of
-          # the most recent idle period
-          break
 
-      return (idle_periods[0] - idle_start).total_seconds() / 3600
-    else:
-      # if idle_periods is of length 0 then it means we haven't been idle
-      return 0
+def fetch_metric_data_chunk(cw, chunk, start_time, end_time):
+  """
+  Fetches datapoints for at most MAX_METRIC_DATA_QUERIES (instance id, metric
+  name) queries with GetMetricData, following NextToken.
+
+  No unit is given as every metric we ask for has a single unit.
+
+  Returns a list of (timestamps, values), one per query and newest first.
+  """
+  metric_data_queries = [
+      {
+          'Id': f'm{idx}',
+          'MetricStat': {
+              'Metric': {
+                  'Namespace': 'AWS/EC2',
+                  'MetricName': metricname,
+                  'Dimensions': [{
+                      'Name': 'InstanceId', 'Value': instance_id
+                  }]
+              },
+              'Period': REPORTING_PERIOD_SECS,
+              'Stat': 'Average'
+          }
+      } for idx, (instance_id, metricname) in enumerate(chunk)
+  ]
+
+  results = [([], []) for _ in chunk]
+  kwargs = {}
+  while True:
+    resp = cw.get_metric_data(
+        MetricDataQueries=metric_data_queries,
+        StartTime=start_time,
+        EndTime=end_time,
+        ScanBy='TimestampDescending',
+        **kwargs)
+
+    for result in resp['MetricDataResults']:
+      timestamps, values = results[int(result['Id'][1:])]
+      timestamps.extend(result['Timestamps'])
+      values.extend(result['Values'])
 
-  def __str__(self):
-    return f'{self.name:64s}  {self.InstanceId}  {self.InstanceType:16s} {self.state}'
+    nexttoken = resp.get('NextToken')
+    if nexttoken is None:
+      break
+    kwargs['NextToken'] = nexttoken
+
+  return results
+
+
+def reporting_window(now):
+  """
+  Returns the (start, end) of the window of datapoints looked at by a run at
+  now.
+
+  The window is aligned to the reporting period so that runs within the same
+  period ask for, and can share, exactly the same datapoints.
+  """
+  end_time = now - (now - datetime(1970, 1, 1)) % timedelta(seconds=REPORTING_PERIOD_SECS)
+  return end_time - timedelta(hours=REPORTING_LOOKBACK_TIME_HOURS), end_time
+
+
+@contextmanager
+def open_metric_cache(cache_path, now):
+  """
+  Opens the metric cache at cache_path, using shelve, for a run at now.
+
+  Datapoints are kept until the end of the current reporting period. Disk
+  metric families (see disk_metric_family) don't change so are kept for as
+  long as the cache is. They are loaded into _DISK_METRIC_FAMILIES on opening
+  and saved back on closing.
+
+  The cache can't be shared between runs so it is locked while open. If
+  another run has it locked, or cache_path is None, a plain dict is used
+  instead and nothing is cached between runs.
+  """
+  if cache_path is None:
+    yield {}
+    return
+
+  with open(f'{cache_path}.lock', 'w') as lock:
+    try:
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      locked = True
+    except BlockingIOError:
+      locked = False
+
+    # yield outside the except block so errors raised by the caller aren't
+    # chained to the BlockingIOError
+    if not locked:
+      print(f'Metric cache {cache_path} is in use by another run, not using it')
+      yield {}
+      return
+
+    _, end_time = reporting_window(now)
+    with shelve.open(cache_path) as cache:
+      window_end_time = cache.get(METRIC_CACHE_WINDOW_KEY)
+      disk_metric_families = cache.get(METRIC_CACHE_DISK_METRIC_FAMILIES_KEY, {})
+
+    # datapoints cached for an earlier window are stale. Recreate the file
+    # rather than deleting them one by one, which is slow and leaves the
+    # space they used behind
+    flag = 'c' if window_end_time == end_time else 'n'
+    with shelve.open(cache_path, flag=flag) as cache:
+      if flag == 'n':
+        cache[METRIC_CACHE_WINDOW_KEY] = end_time
+        cache[METRIC_CACHE_DISK_METRIC_FAMILIES_KEY] = disk_metric_families
+
+      _DISK_METRIC_FAMILIES.update(disk_metric_families)
+      try:
+        yield cache
+      finally:
+        cache[METRIC_CACHE_DISK_METRIC_FAMILIES_KEY] = dict(_DISK_METRIC_FAMILIES)
+
+
+def fetch_metric_data(cw, queries, now, cache=None):
+  """
+  Fetches datapoints for a list of (instance id, metric name) queries using
+  as few GetMetricData calls as possible, issuing them concurrently. The
+  datapoints are those in the reporting_window of now.
+
+  If cache, from open_metric_cache, is given then datapoints already in it
+  aren't fetched again and those fetched are added to it. Raw datapoints are
+  cached so changing idleness thresholds does not invalidate the cache.
+
+  Returns a dict mapping instance id to a dict mapping metric name to
+  (timestamps, values), newest first.
+  """
+  start_time, end_time = reporting_window(now)
+  if cache is None:
+    cache = {}
+
+  def cache_key(query):
+    instance_id, metricname = query
+    return f'{instance_id}:{metricname}'
+
+  uncached_queries = [q for q in queries if cache_key(q) not in cache]
+  chunks = [
+      uncached_queries[offset:offset + MAX_METRIC_DATA_QUERIES]
+      for offset in range(0, len(uncached_queries), MAX_METRIC_DATA_QUERIES)
+  ]
+
+  # boto3 clients are thread safe, and the calls are all waiting on the
+  # network, so a single client shared between threads will do
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    chunk_results = executor.map(
+        lambda chunk: fetch_metric_data_chunk(cw, chunk, start_time, end_time), chunks)
+
+    for chunk, results in zip(chunks, chunk_results):
+      for query, result in zip(chunk, results):
+        cache[cache_key(query)] = result
+
+  metric_data = {}
+  for query in queries:
+    instance_id, metricname = query
+    metric_data.setdefault(instance_id, {})[metricname] = cache[cache_key(query)]
+
+  return metric_data
 
 
 @click.command()
@@ -245,6 +525,14 @@ class Instance(dict):
     help='When given a test message is sent into slack. Intended for '
     'verifying slack integration. No other action will be taken')
 @click.option('-r', '--region', type=str, default=None, help='The AWS region to check')
+@click.option(
+    '--metric-cache',
+    type=click.Path(dir_okay=False),
+    default=None,
+    help='File in which to cache CloudWatch datapoints between runs. Datapoints '
+    'are reused until the end of the current reporting period, disk metric '
+    'families for as long as the file exists. Runs that overlap with one '
+    'already using the file run without a cache')
 def main(*args, **kwargs):
   if kwargs['test_slack']:
     slack_send(kwargs['test_slack'])
@@ -276,7 +564,8 @@ def reaper(
     include_stopped,
     warning_callback,
     stop_instance_callback,
-    region):
+    region,
+    metric_cache=None):
 
   if stop_instance_idle_timeout_hours > REPORTING_LOOKBACK_TIME_HOURS:
     raise Exception(
@@ -287,72 +576,223 @@ def reaper(
     raise Exception(
         f'warning idle timeout ({warning_idle_timeout_hours}) cannot be longer than '
         f'{REPORTING_LOOKBACK_TIME_HOURS} hours.')
-  ec2 = boto3.client('ec2', region_name=region)
+
+  # every instance is checked against the same window of time
+  now = datetime.utcnow()
+
+  ec2 = client('ec2', region)
+
+  # unless asked otherwise have EC2 leave out instances that aren't running
+  # rather than fetching them only to skip them
+  filters = [] if include_stopped else [{'Name': 'instance-state-name', 'Values': ['running']}]
+  paginator = ec2.get_paginator('describe_instances')
 
   instances_vec = []
-  done = False
-  nexttoken = ''
-  while not done:
-    resp = ec2.describe_instances(NextToken=nexttoken)
+  instance_args = [min_cpu_utilisation, min_disk_ops, min_network_packets]
+  for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+    for reservation in page['Reservations']:
+      instances_vec.extend(
+          Instance(d, *instance_args, region=region) for d in reservation['Instances'])
 
-    instance_args = [min_cpu_utilisation, min_disk_ops, min_network_packets]
-    for reservation in resp['Reservations']:
-      instances_vec += [Instance(d, *instance_args) for d in reservation['Instances']]
+  # output is buffered and written out in one go by flush, rather than a
+  # print per instance
+  lines = []
 
-    nexttoken = resp.get('NextToken')
-    if nexttoken is None:
-      done = True
+  def flush():
+    if lines:
+      print('\n'.join(lines))
+      lines.clear()
 
   # keep only those instances whose type that match INSTANCE_TYPE_REGEX
   if verbose:
-    print('Instances')
-    print('=========')
-    instances_vec.sort(key=lambda i: i.state)
-    for inst in instances_vec:
-      print(inst)
+    lines.extend(['Instances', '========='])
+    if include_stopped:
+      # otherwise every instance is running, see filters above
+      instances_vec.sort(key=lambda i: i.state)
+    lines.extend(str(inst) for inst in instances_vec)
 
   if verbose:
-    print('')
-    print('Idleness')
-    print('========')
+    lines.extend(['', 'Idleness', '========'])
 
-  warned = 0
-  stopped = 0
-  checked = 0
+  to_check = []
   for inst in instances_vec:
-    if not inst.is_running and not include_stopped:
-      print(f"{inst.name:64s}  not checked: not running")
-      continue
-
     if INSTANCE_TYPE_REGEX.search(inst.InstanceType) is None:
-      print(f"{inst.name:64s}  not checked: instance type ({inst.InstanceType}) doesn't match")
+      lines.append(
+          f"{inst.name:64s}  not checked: instance type ({inst.InstanceType}) doesn't match")
       continue
 
+    to_check.append(inst)
+
+  flush()
+
+  # fetch metrics for every instance up front in as few calls as possible
+  # rather than making a call per metric per instance
+  cw = client('cloudwatch', region)
+
+  with open_metric_cache(metric_cache, now) as cache:
+
+    def prefetch(instances, metricnames_func):
+      queries = [
+          (inst.InstanceId, metricname) for inst in instances
+          for metricname in metricnames_func(inst)
+      ]
+      metric_data = fetch_metric_data(cw, queries, now, cache=cache)
+      for inst in instances:
+        inst.metric_data.update(metric_data.get(inst.InstanceId, {}))
+
+    if verbose:
+      # every metric is reported so we need them all
+      probe_disk_metric_families(to_check)
+      prefetch(to_check, lambda inst: inst.idleness_metrics)
+    else:
+      # idle_period_hours doesn't look past CPU if it isn't idle, so only fetch
+      # the remaining metrics for those instances whose CPU is idle
+      prefetch(to_check, lambda inst: ['CPUUtilization'])
+      cpu_idle_instances = [inst for inst in to_check if inst.cpu_idle_period_hours > 0]
+      probe_disk_metric_families(cpu_idle_instances)
+      prefetch(
+          cpu_idle_instances,
+          lambda inst: [m for m in inst.idleness_metrics if m != 'CPUUtilization'])
+
+  warned = 0
+  stopped = 0
+  checked = 0
+  for inst in to_check:
     checked += 1
-    if inst.idle_period_hours < stop_instance_idle_timeout_hours:
-      if inst.idle_period_hours >= warning_idle_timeout_hours:
+    idle_period_hours = inst.idle_period_hours
+    if idle_period_hours < stop_instance_idle_timeout_hours:
+      if idle_period_hours >= warning_idle_timeout_hours:
         if dry_run:
-          print('  Would have issued warning')
+          lines.append('  Would have issued warning')
         else:
+          # callbacks may print, keep their output in order with ours
+          flush()
           warning_callback(inst)
           warned += 1
     else:
       if dry_run:
-        print('  Would have stopped instance')
+        lines.append('  Would have stopped instance')
       else:
+        flush()
         stop_instance_callback(inst)
         stopped += 1
 
     if verbose:
-      print(
+      lines.append(
           f'{inst.name} cpu_idle={inst.cpu_idle_period_hours:.2f} '
-          f'net_idle={inst.network_idle_period_hours:.2f}',
+          f'net_idle={inst.network_idle_period_hours:.2f} '
           f'disk_idle={inst.disk_idle_period_hours:.2f}')
 
-  print('')
-  print('Summary')
-  print('=======')
-  print(f'Checked {checked} instances, issued {warned} warnings and stopped {stopped}.')
+  lines.extend([
+      '',
+      'Summary',
+      '=======',
+      f'Checked {checked} instances, issued {warned} warnings and stopped {stopped}.',
+  ])
+  flush()
+
+
+def test_get_idle_period_hours_for_metric():
+  inst = Instance(
+      {
+          'InstanceId': 'i-0', 'InstanceType': 'm5.large', 'State': {
+              'Name': 'running', 'Code': 16
+          }
+      },
+      min_cpu_utilisation=3,
+      min_disk_ops=1,
+      min_network_packets=100)
+
+  # datapoints are newest first, as fetch_metric_data asks for them
+  now = datetime(2020, 1, 1)
+  period = timedelta(seconds=REPORTING_PERIOD_SECS)
+  timestamps = [now - i * period for i in range(6)]
+
+  def idle_hours(timestamps, values):
+    inst.metric_data['CPUUtilization'] = (timestamps, values)
+    return inst.get_idle_period_hours_for_metric('CPUUtilization', 3)
+
+  def hours(periods):
+    return (periods * period).total_seconds() / 3600
+
+  # idle throughout
+  assert idle_hours(timestamps, [0] * 6) == hours(5)
+
+  # idle for the 3 most recent datapoints, then active, then idle again
+  assert idle_hours(timestamps, [0, 0, 0, 10, 0, 0]) == hours(2)
+
+  # a missing datapoint also breaks idleness
+  assert idle_hours(timestamps[:2] + timestamps[3:], [0] * 5) == hours(1)
+
+  # active throughout
+  assert idle_hours(timestamps, [10] * 6) == 0
+
+  # no datapoints, or no such metric
+  assert idle_hours([], []) == -1
+  assert inst.get_idle_period_hours_for_metric('NetworkPacketsIn', 100) == -1
+
+
+
+def test_metric_cache(tmp_path):
+  class StubCloudWatch:
+    def __init__(self):
+      self.queries = []
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, ScanBy, **kwargs):
+      self.queries.extend(MetricDataQueries)
+      return {
+          'MetricDataResults': [{
+              'Id': q['Id'], 'Timestamps': [EndTime], 'Values': [0]
+          } for q in MetricDataQueries]
+      }
+
+  cache_path = str(tmp_path / 'metric-cache')
+  period = timedelta(seconds=REPORTING_PERIOD_SECS)
+  now = datetime(2020, 1, 1)
+  later = now + period
+  queries = [('i-0', 'CPUUtilization'), ('i-0', 'NetworkPacketsIn')]
+
+  # windows end on the last reporting period boundary
+  start_time, end_time = reporting_window(now + period / 2)
+  assert end_time == now
+  assert end_time - start_time == timedelta(hours=REPORTING_LOOKBACK_TIME_HOURS)
+
+  saved_disk_metric_families = dict(_DISK_METRIC_FAMILIES)
+  _DISK_METRIC_FAMILIES.clear()
+  try:
+    # a cold cache fetches everything
+    cw = StubCloudWatch()
+    with open_metric_cache(cache_path, now) as cache:
+      metric_data = fetch_metric_data(cw, queries, now, cache=cache)
+      _DISK_METRIC_FAMILIES[(None, 'm5')] = 'EBS'
+    assert len(cw.queries) == 2
+    assert metric_data['i-0']['CPUUtilization'] == ([now], [0])
+
+    # a warm cache in the same window fetches nothing
+    _DISK_METRIC_FAMILIES.clear()
+    cw = StubCloudWatch()
+    with open_metric_cache(cache_path, now + period / 2) as cache:
+      assert fetch_metric_data(cw, queries, now + period / 2, cache=cache) == metric_data
+    assert cw.queries == []
+    assert _DISK_METRIC_FAMILIES == {(None, 'm5'): 'EBS'}
+
+    # a new window drops datapoints but keeps disk metric families
+    _DISK_METRIC_FAMILIES.clear()
+    cw = StubCloudWatch()
+    with open_metric_cache(cache_path, later) as cache:
+      assert fetch_metric_data(cw, queries, later, cache=cache)['i-0']['CPUUtilization'] == (
+          [later], [0])
+    assert len(cw.queries) == 2
+    assert _DISK_METRIC_FAMILIES == {(None, 'm5'): 'EBS'}
+
+    # a run that overlaps one holding the lock doesn't use the cache
+    with open(f'{cache_path}.lock', 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      with open_metric_cache(cache_path, later) as cache:
+        assert cache == {}
+  finally:
+    _DISK_METRIC_FAMILIES.clear()
+    _DISK_METRIC_FAMILIES.update(saved_disk_metric_families)
 
 
 if __name__ == '__main__':